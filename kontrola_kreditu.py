@@ -4,11 +4,14 @@
 # Ján Gajdica 17. 9. 2016
 
 import serial
-from time import sleep
+import sqlite3
+import os.path
+from time import sleep, time
 import threading as thd
 import subprocess as sub
 import tkinter as tkold
 import tkinter.ttk as tk
+from sms import RecordingPort, ReplayPort
 
 def fail ():
     window.buttonsDisable()
@@ -70,12 +73,14 @@ class Initializer (thd.Thread):
     """Stops network connection through serial port,
     freeing it for communication with modem.
     Sets up modem for SMS send/receive in text mode.
+    Expires SMS left unsent in outbox by earlier session.
     Doesn't turn the networking back on."""
 
-    def __init__ (self, window, modem):
+    def __init__ (self, window, modem, outbox):
         super().__init__()
         self.window = window
         self.modem = modem
+        self.outbox = outbox
 
     def run (self):
         self.window.buttonsDisable()
@@ -85,6 +90,11 @@ class Initializer (thd.Thread):
             self.modem.getPort()
             self.window.display ('Pripájanie do mobilnej siete...')
             assert self.modem.initCellular()
+            expired = self.outbox.expire()
+            if expired > 0:
+                self.window.display ('Neodoslané SMS z minulého spustenia: '  \
+                    + str (expired) + ' - zrušené.')
+                sleep (3)   # let the user read it
             self.window.display ('Inicializácia dokončená.\nMôžete poslať SMS.')
             self.window.spotrebaPress() # Default action
         except:
@@ -99,12 +109,13 @@ class SMShandler (thd.Thread):
     and displays it through given window. 
     Expects modems port to be acquired and free to use."""
 
-    def __init__ (self, window, modem, sendTo, SMStext):
+    def __init__ (self, window, modem, outbox, sendTo, SMStext):
         super().__init__()
         self.to = int (sendTo)
         self.text = str (SMStext)
         self.window = window
         self.modem = modem
+        self.outbox = outbox
 
     def run (self):
         try:
@@ -112,19 +123,20 @@ class SMShandler (thd.Thread):
             self.window.display ('Konfigurácia modemu...')
             assert self.modem.initSMS()
             self.window.display ('Posiela sa SMS...')
-            maxAttempts = 5
-            for attempt in range (1, maxAttempts + 1):
-                if self.modem.sendSMS (self.to, self.text): break
-                if attempt == maxAttempts: raise AssertionError
+            rowid = self.outbox.enqueue (self.to, self.text)
+            # only this one - leftovers were expired by Initializer
+            result = self.outbox.drain (self.modem, ids = [rowid])
+            if result.get (rowid) != 'submitted':
+                raise AssertionError
             self.window.display ('SMS odoslaná, čaká sa na odpoveď...')
             maxAttempts = 400   # Receiving SMS response:
             for attempt in range (1, maxAttempts + 1):
                 if attempt == maxAttempts:
                     raise AssertionError
-                if self.modem.cntSMS() == 1: break
+                if self.modem.storage.count() == 1: break
                 sleep (0.25)   # Waiting for sms
 
-            message = modem.readSMS()[0]    # The one and only message
+            message = self.modem.storage.read()[0]  # The one and only message
             if int (message[0]) != int (self.to):   # number of the message sender
                 # message is not the expected response from adressate
                 raise AssertionError
@@ -135,9 +147,134 @@ class SMShandler (thd.Thread):
 
             self.window.display (message[2])    # Display the actual message text
             self.window.buttonsEnable()
-        except AssertionError:
+        except (AssertionError, sqlite3.Error):
             fail()
 
+class Outbox (object):
+    """Persistent queue of outgoing SMS in SQLite database (WAL mode).
+    Every message is in one of the states:
+    queued - waiting to be sent,
+    claimed - picked up for sending in this batch, not sent yet,
+    sending - handed over to modem, result not yet recorded,
+    submitted - accepted by network, reference holds message reference,
+    failed - not sent, or outcome unknown after crash,
+    expired - left queued by earlier session, never sent (see expire).
+    Only one message at a time is in state sending, so after crash
+    only that one is in doubt - it's marked failed, never sent again,
+    so retries after crash can't double-send."""
+
+    def __init__ (self, path):
+        """Opens (creates) the database and recovers from crash:
+        message left in state sending is marked failed,
+        claimed messages go back to queue."""
+        self.lock = thd.Lock()
+        self.db = sqlite3.connect (path, check_same_thread = False)
+        self.db.execute ('PRAGMA journal_mode = WAL')
+        self.db.execute ('PRAGMA synchronous = FULL')
+        with self.db:
+            self.db.execute ('CREATE TABLE IF NOT EXISTS outbox ('  \
+                'id INTEGER PRIMARY KEY, '                          \
+                'key TEXT UNIQUE, '                                 \
+                'recipient TEXT NOT NULL, '                         \
+                'message TEXT NOT NULL, '                           \
+                'state TEXT NOT NULL, '                             \
+                'reference INTEGER, '                               \
+                'updated REAL NOT NULL)')
+            self.db.execute ('CREATE INDEX IF NOT EXISTS outbox_state '   \
+                'ON outbox (state, id)')
+            self.db.execute ("UPDATE outbox SET state = 'failed', "  \
+                "updated = ? WHERE state = 'sending'", (time(),))
+            self.db.execute ("UPDATE outbox SET state = 'queued', "  \
+                "updated = ? WHERE state = 'claimed'", (time(),))
+
+    def enqueue (self, to, message, key = None):
+        """Stores message for sending, returns its id.
+        key - optional idempotency key: if message with the same key
+        was already enqueued, nothing is stored and id of
+        the original message is returned."""
+        with self.lock, self.db:
+            if key is not None:
+                row = self.db.execute ('SELECT id FROM outbox WHERE key = ?', \
+                    (str (key),)).fetchone()
+                if row is not None: return row[0]
+                key = str (key)
+            return self.db.execute ('INSERT INTO outbox '               \
+                '(key, recipient, message, state, updated) '            \
+                "VALUES (?, ?, ?, 'queued', ?)",                        \
+                (key, str (to), str (message), time())).lastrowid
+
+    def expire (self):
+        """Marks all queued messages expired, so they are never sent.
+        Called at start, when queued messages are left by earlier
+        session - sending them unasked could buy data package again.
+        Returns int - number of expired messages."""
+        with self.lock, self.db:
+            return self.db.execute ("UPDATE outbox SET state = 'expired', "  \
+                "updated = ? WHERE state = 'queued'", (time(),)).rowcount
+
+    def state (self, rowid):
+        """Returns tuple (state, reference) of the message
+        or None if there is no such message."""
+        with self.lock:
+            return self.db.execute ('SELECT state, reference FROM outbox '  \
+                'WHERE id = ?', (rowid,)).fetchone()
+
+    def claim (self, batchSize, ids = None):
+        """Moves up to batchSize oldest queued messages (only those
+        with given ids, if any) to state claimed in single commit.
+        Returns list of tuples (id, recipient, message)."""
+        query = 'SELECT id, recipient, message FROM outbox '   \
+            "WHERE state = 'queued'"
+        params = list()
+        if ids is not None:
+            query += ' AND id IN (' + ', '.join ('?' * len (ids)) + ')'
+            params = list (ids)
+        with self.lock, self.db:
+            batch = self.db.execute (query + ' ORDER BY id LIMIT ?',    \
+                params + [batchSize]).fetchall()
+            self.db.executemany ("UPDATE outbox SET state = 'claimed', "  \
+                'updated = ? WHERE id = ?',                              \
+                [(time(), rowid) for rowid, _, _ in batch])
+        return batch
+
+    def mark (self, rowid):
+        """Commits claimed message as sending - right before it is sent."""
+        with self.lock, self.db:
+            self.db.execute ("UPDATE outbox SET state = 'sending', "   \
+                'updated = ? WHERE id = ?', (time(), rowid))
+
+    def finish (self, rowid, state, reference = None):
+        """Commits result of sent message - right after it is known."""
+        with self.lock, self.db:
+            self.db.execute ('UPDATE outbox SET state = ?, '    \
+                'reference = ?, updated = ? WHERE id = ?',      \
+                (state, reference, time(), rowid))
+
+    def drain (self, modem, ids = None, batchSize = 20, maxAttempts = 5):
+        """Sends queued messages through modem - all of them,
+        or only those with given ids.
+        Messages are claimed per batch, each one is marked sending
+        and its result recorded in its own commit.
+        Returns dict id -> state of the messages processed."""
+        processed = dict()
+        while True:
+            batch = self.claim (batchSize, ids)
+            if not batch: break
+            for rowid, to, message in batch:
+                self.mark (rowid)
+                for attempt in range (maxAttempts):
+                    ref = modem.submitSMS (to, message)
+                    # -2 - text may have been sent, retry could double-send
+                    if ref != -1: break
+                    sleep (0.1)
+                if ref >= 0:
+                    self.finish (rowid, 'submitted', ref)
+                    processed[rowid] = 'submitted'
+                else:
+                    self.finish (rowid, 'failed')
+                    processed[rowid] = 'failed'
+        return processed
+
 class Datetime (object):
     """represents year, month, day, hour, minute and second of the day"""
 
@@ -175,15 +312,23 @@ class Modem (object):
         This is so that placeholder empty modem can be __initialised__
         without throwing exceptions and actual port acquiring needs to
         happen only once. This should awoid multiple access on port."""
-        pass
+        self.storage = StorageManager (self)
 
-    def getPort (self):
+    def getPort (self, record = None):
         """opens USB port:
-        use write_timeout or writeTimeout depending on version of pyserial"""
+        use write_timeout or writeTimeout depending on version of pyserial.
+        record - path of file to record the serial session to."""
         self.port = serial.Serial (port = '/dev/ttyUSB0',   \
                                baudrate = 9600,             \
                                 timeout = 0.2,              \
                            writeTimeout = 0.2)
+        if record is not None:
+            self.port = RecordingPort (self.port, record)
+
+    def replayPort (self, path, speed = 1.0):
+        """Uses session recorded by getPort instead of USB port,
+        so that chat, readSMS, submitSMS... run without modem."""
+        self.port = ReplayPort (path, speed)
  
     def chat (self, command):
         """sends bytearray containing command to modem,
@@ -230,7 +375,7 @@ class Modem (object):
         attempts = 0
         maxAttempts = 100
         li = [self.isOK, self.setModeText, self.setEncodingIRA,   \
-            self.setStorageSM, self.deleteSMS]
+            self.storage.select, self.deleteSMS]
         for func in li:
             while not func():
                 sleep (0.1)
@@ -288,33 +433,101 @@ class Modem (object):
         """Deletes all SMS messages stored on modem."""
         return  self.chat (b'AT+CMGD=0,4\r') == [b'OK']
 
+    def storages (self):
+        """Returns list of str - SMS memories (ME, SM, MT...) supported
+        by modem alike for reading, writing and receiving."""
+        response = self.chat (b'AT+CPMS=?\r')
+        try:
+            if response[-1] != b'OK': return []
+            if response[0][:7] != b'+CPMS: ': return []
+        except IndexError:
+            return []
+        memories = None
+        for group in response[0][7:].split (b'),('):
+            names = group.strip (b'()').replace (b'"', b'').split (b',')
+            names = set (name.decode ('ASCII', 'replace') for name in names)
+            memories = names if memories is None else memories & names
+        return sorted (name for name in memories if name)
+
+    def storageStatus (self):
+        """Returns list of tuples (str (memory), int (used), int (total))
+        for read, write and receive memory - full AT+CPMS? response.
+        If requst doesn't succeed, returns empty list."""
+        return self.parseStorage (self.chat (b'AT+CPMS?\r'), [])
+
+    def setStorage (self, memory, receive = None):
+        """Sets SMS memories for reading and writing to memory,
+        for receiving to receive (memory if not given).
+        Returns list like storageStatus, empty if it doesn't succeed."""
+        names = [str (memory)] * 2 + [str (receive or memory)]
+        response = self.chat (b'AT+CPMS=' + b','.join (    \
+            b'"' + bytearray (name, 'ASCII') + b'"' for name in names) + b'\r')
+        return self.parseStorage (response, names)
+
+    def parseStorage (self, response, names):
+        """Parses +CPMS response of query or set command (which doesn't
+        name memories - names holds them then)."""
+        try:
+            if response[-1] != b'OK': return []
+            if response[0][:7] != b'+CPMS: ': return []
+            names = list (names)
+            numbers = list()
+            for field in response[0][7:].split (b','):
+                field = field.strip()
+                if field[:1] == b'"':
+                    names.append (field.strip (b'"').decode ('ASCII', 'replace'))
+                else:
+                    numbers.append (int (field))
+        except (IndexError, ValueError):
+            return []
+        return [(name, used, total) for name, used, total   \
+            in zip (names, numbers[0::2], numbers[1::2])]
+
     def cntSMS (self):
         """Returns int - number of sms messages currently in storage.
         If requst doesn't succeed, returns -1."""
-        response = modem.chat (b'AT+CPMS?\r')
-        try:
-            if response[1] != b'OK': return -1
-            return int (str (response[0]).split (',')[1])
-        except IndexError:
-            return -1
+        status = self.storageStatus()
+        if not status: return -1
+        return status[0][1]
         
     def sendSMS (self, to, message):
         """Sends sms in text mode. to - number to send SMS to.
         message - text of the message - ASCII only due to text mode."""
+        return self.submitSMS (to, message) >= 0
+
+    def submitSMS (self, to, message, timeout = 30):
+        """Sends sms same as sendSMS. Returns int - message reference
+        assigned by network. Returns -1 if nothing was sent (no prompt
+        for text, ERROR or +CMS ERROR) and -2 if text was sent,
+        but not confirmed within timeout seconds."""
         response = self.chat (  \
             b'AT+CMGS="'        \
             + bytearray (str (to), 'ASCII') + b'"\r')
         try:
-            if response[0] != b'> ': return False   # prompt for sms input
-        except IndexError: return False
-        response = self.chat (                  \
-            bytearray (str (message), 'ASCII')  \
-            + b'\r\x1A')
-        for part, i in zip (response, range (99)):
-            if part == b'OK':
-                if response[i - 1][:6] == b'+CMGS:':
-                    return True
-        return False
+            if response[0] != b'> ': return -1   # prompt for sms input
+        except IndexError: return -1
+        self.port.write (bytearray (str (message), 'ASCII') + b'\r\x1A')
+        self.port.flush()
+        # network confirms in seconds, chat would give up after 0.2 s:
+        res = b''
+        clock = getattr (self.port, 'clock', time)  # replay has own time
+        deadline = clock() + timeout
+        while clock() < deadline:
+            try:
+                res += self.port.read (100)
+            except: pass
+            reference = -2
+            for line in res.split (b'\r\n')[:-1]:    # complete lines only
+                if line[:6] == b'+CMGS:':
+                    try:
+                        reference = int (line[6:])
+                    except ValueError:
+                        pass
+                elif line == b'OK':
+                    return reference
+                elif line == b'ERROR' or line[:11] == b'+CMS ERROR:':
+                    return -1   # refused by modem or network
+        return -2
         
     def readSMS (self):
         """Returns text of sms messages stored on modem
@@ -338,6 +551,135 @@ class Modem (object):
             n += 1
         return messages
 
+class StorageManager (object):
+    """Chooses SMS storage - ME (modem memory), MT (modem and SIM)
+    or SM (SIM card, usually only 10-50 messages) - prefering
+    the larger and faster ME. Keeps track of free slots and makes room
+    before the storage gets full, so incoming SMS are never rejected.
+    After spill, messages are received to other memory than
+    they are read from - read and count cover both."""
+
+    preference = ['ME', 'MT', 'SM']
+
+    def __init__ (self, modem, lowWater = 2):
+        """lowWater - number of free slots at which room is made."""
+        self.modem = modem
+        self.lowWater = lowWater
+        self.capacity = dict()  # memory -> [used, total]
+        self.memory = None      # read (and write) memory
+        self.receive = None     # receive memory
+
+    def probe (self):
+        """Reads used and total slots of every supported memory
+        (switching to each one). If modem doesn't list its memories,
+        falls back to the current one, or SIM. Returns bool."""
+        self.capacity = dict()
+        self.memory = self.receive = None
+        for memory in self.modem.storages():
+            if memory not in self.preference: continue   # SR, BM...
+            status = self.modem.setStorage (memory)
+            if status: self.capacity[memory] = list (status[0][1:])
+        if not self.capacity:
+            status = self.modem.storageStatus()
+            memory = status[0][0] if status else 'SM'
+            status = self.modem.setStorage (memory)
+            if status: self.capacity[memory] = list (status[0][1:])
+        return len (self.capacity) > 0
+
+    def free (self, memory = None):
+        """Returns int - free slots known for memory (receive memory
+        by default), without asking the modem."""
+        used, total = self.capacity[memory or self.receive]
+        return total - used
+
+    def overlaps (self, memory, other):
+        """Returns bool - memories hold the same messages
+        (MT is ME and SM together)."""
+        return memory == other or 'MT' in (memory, other)
+
+    def switch (self, memory):
+        """Sets all memories to memory. Returns bool."""
+        status = self.modem.setStorage (memory)
+        if not status: return False
+        self.memory = self.receive = memory
+        self.capacity[memory] = list (status[0][1:])
+        return True
+
+    def using (self, memory, func):
+        """Returns result of func run with memory as read memory
+        (AT+CMGL, AT+CMGD work on it), None if memory can't be set.
+        Receive memory stays the same."""
+        if memory == self.memory: return func()
+        if not self.modem.setStorage (memory, self.receive): return None
+        try:
+            return func()
+        finally:
+            self.modem.setStorage (self.memory, self.receive)
+
+    def select (self):
+        """Switches modem to the most preferred memory with room left.
+        Probes the memories on first call. Returns bool."""
+        if not self.capacity and not self.probe(): return False
+        memories = [m for m in self.preference if m in self.capacity]  \
+            or list (self.capacity)
+        for memory in memories:
+            if self.free (memory) > self.lowWater: break
+        else:
+            memory = memories[0]    # all full - makeRoom compacts it
+        if not self.switch (memory): return False
+        if self.free() <= self.lowWater: self.makeRoom()
+        return True
+
+    def count (self):
+        """Returns int - number of sms messages in read and receive
+        memory, refreshes free slots and makes room when receive memory
+        is nearly full. If requst doesn't succeed, returns -1."""
+        status = self.modem.storageStatus()
+        if not status: return -1
+        for memory, used, total in status:
+            self.capacity[memory] = [used, total]
+        cnt = status[0][1]
+        if not self.overlaps (status[-1][0], status[0][0]):
+            cnt += status[-1][1]
+        if self.receive is not None and self.free() <= self.lowWater:
+            self.makeRoom()
+        return cnt
+
+    def read (self):
+        """Returns messages like Modem.readSMS
+        from read memory and then from receive memory."""
+        messages = self.modem.readSMS()
+        if self.receive is not None   \
+                and not self.overlaps (self.receive, self.memory):
+            messages += self.using (self.receive, self.modem.readSMS) or []
+        return messages
+
+    def makeRoom (self):
+        """Compacts receive memory - deletes messages already read
+        (unread are kept). If still nearly full, spills - switches
+        receive memory to another one with room left, read memory
+        stays, so unread messages can be still read. MT is not used
+        for spill from ME or SM, it holds their messages too.
+        Returns bool - there is room."""
+        delete = lambda: self.modem.chat (b'AT+CMGD=0,1\r') == [b'OK']
+        if self.using (self.receive, delete):
+            status = self.modem.storageStatus()
+            for memory, used, total in status:
+                self.capacity[memory] = [used, total]
+        if self.free() > self.lowWater: return True
+        for memory in self.preference:
+            if memory == self.receive or memory not in self.capacity: continue
+            # read memory must not overlap - messages would count twice:
+            if memory != self.memory and self.overlaps (memory, self.memory):
+                continue
+            if self.free (memory) > self.lowWater:
+                status = self.modem.setStorage (self.memory, memory)
+                if not status: return False
+                self.receive = memory
+                self.capacity[memory] = list (status[-1][1:])
+                return True
+        return False
+
 class Window (tk.Frame):
     """The one and only gui window"""
 
@@ -422,18 +764,19 @@ class Window (tk.Frame):
 
     def spotrebaPress (self):
         """What to do when button spotreba is pressed in gui"""
-        SMShandler (self, modem, 950, 'SPOTREBA').start()
+        SMShandler (self, modem, outbox, 950, 'SPOTREBA').start()
 
     def gigaPress (self):
         """What to do when button giga is pressed in gui"""
-        SMShandler (self, modem, 950, 'GIGA').start()
+        SMShandler (self, modem, outbox, 950, 'GIGA').start()
 
 kTinkerRoot = tkold.Tk()
 kTinkerRoot.style = tk.Style()
 kTinkerRoot.style.theme_use ('clam')    # Looks the best
 window = Window (master = kTinkerRoot)
 modem = Modem ()
-Initializer (window, modem).start()
+outbox = Outbox (os.path.expanduser ('~/.kontrola_kreditu.sqlite'))
+Initializer (window, modem, outbox).start()
 window.mainloop()
 startNetworking()   # switch it back on
 
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+# Network manager, ModemManager and pppd don't lock the ports
+# they use, so the scan can't tell a port in live data session
+# from a free one - AT commands would be written into it.
+# Switch broadband off first (nmcli radio wwan off, as stopNetworking
+# in kontrola_kreditu.py does). Only ports with UUCP lock file
+# (/var/lock/LCK..ttyUSB0) or locked by other pyserial program
+# are recognized as used and skipped.
+
+import os
+import sys
+import json
+import glob
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from sms import Modem
+
+lockDirs = ['/var/lock', '/run/lock']
+
+def ports ():
+    """Returns list of str - serial ports modems may be on.
+    /dev/serial/by-id names are stable, so they are prefered,
+    ttyUSB ports they link to are not listed again.
+    Each port must be listed once - it can't be opened twice at once."""
+    byId = sorted (glob.glob ('/dev/serial/by-id/*'))
+    linked = set (os.path.realpath (port) for port in byId)
+    return byId + [port for port in sorted (glob.glob ('/dev/ttyUSB*'))  \
+        if port not in linked]
+
+def locker (device):
+    """Returns int - pid of process holding UUCP lock file of device,
+    -1 if the pid can't be read, 0 if device isn't locked
+    (no lock file or its process is gone)."""
+    for lockDir in lockDirs:
+        path = os.path.join (lockDir, 'LCK..' + os.path.basename (device))
+        try:
+            with open (path) as f:
+                pid = int (f.read().strip())
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError):
+            return -1   # locked, but in unknown format
+        try:
+            os.kill (pid, 0)
+        except ProcessLookupError:
+            continue    # stale lock
+        except PermissionError:
+            pass        # alive, process of other user
+        return pid
+    return 0
+
+def usbDevice (device):
+    """Returns str - sysfs path of USB device (modem stick) the tty
+    belongs to - all its interfaces share it. Empty if not known."""
+    path = os.path.realpath (os.path.join ('/sys/class/tty',    \
+        os.path.basename (device), 'device'))
+    if not os.path.exists (path): return ''
+    return os.path.dirname (path)   # interface -> USB device
+
+def probe (port):
+    """Returns dict - health and inventory of modem on given port.
+    Every check is tried once - no retries as in initCellular.
+    Never raises any exception."""
+    device = os.path.realpath (port)
+    report = dict (port = port, device = device, ok = False)
+    pid = locker (device)
+    if pid != 0:
+        report['error'] = 'locked by process ' + str (pid)
+        return report
+    modem = Modem()
+    try:
+        try:
+            # flock - only against other pyserial programs, see above
+            modem.getPort (port = port, exclusive = True)
+        except (ValueError, TypeError):
+            modem.getPort (port = port)   # pyserial older than 3.3
+    except Exception as e:
+        report['error'] = str (e)   # missing, or locked
+        return report
+    try:
+        report['ok'] = modem.isOK()
+        if not report['ok']: return report  # not AT command port
+        report['imei'] = modem.imei()
+        report['pin'] = modem.isPINok()
+        report['imsi'] = modem.imsi()
+        report['operator'] = modem.operator()
+        report['signal'] = modem.signal()
+        report['registration'] = modem.registration()
+        report['storage'] = [dict (memory = memory, used = used, total = total)  \
+            for memory, used, total in modem.storageStatus()]
+    except Exception as e:
+        report['error'] = str (e)
+    finally:
+        try:
+            modem.port.close()
+        except Exception:
+            pass
+    return report
+
+def scan (ports):
+    """Probes all ports at once, returns list of reports in order
+    of ports. Takes about as long as the slowest port."""
+    if not ports: return []
+    with ThreadPoolExecutor (max_workers = len (ports)) as pool:
+        return list (pool.map (probe, ports))
+
+def inventory (reports):
+    """Groups port reports by modem - by USB device, or by IMEI
+    if USB device isn't known. Returns list of dicts, one per modem:
+    inventory from its first AT command port, ports - all its ports,
+    errors - port -> error for ports which couldn't be probed."""
+    modems = dict()
+    for report in reports:
+        key = usbDevice (report['device']) or report.get ('imei')   \
+            or report['device']
+        modem = modems.setdefault (key, dict (usb = usbDevice (report['device']),
+            ok = False, ports = list(), errors = dict()))
+        modem['ports'].append (report['port'])
+        if 'error' in report: modem['errors'][report['port']] = report['error']
+        if report['ok'] and not modem['ok']:
+            for name, value in report.items():
+                if name not in ('port', 'device', 'error'): modem[name] = value
+    return list (modems.values())
+
+if __name__ == '__main__':
+    json.dump (inventory (scan (sys.argv[1:] or ports())),   \
+        sys.stdout, indent = 2)
+    print()
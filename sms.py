@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
-from time import sleep
+from time import sleep, time
+import struct
 import serial
 
 class Datetime (object):
@@ -23,6 +24,117 @@ class Datetime (object):
     def __repr__(self):
         return "'Datetime=" + self.__str__() + "'"
 
+class RecordingPort (object):
+    """Wraps serial port, passes everything through and records
+    timestamped bytes in both directions to file.
+    Each record: struct RECORD (seconds since start, direction, length)
+    followed by the bytes. Reads returning nothing are recorded too,
+    because chat stops reading on them. Every record is flushed
+    right away, so crashed or killed session is recorded to the end."""
+
+    MAGIC = b'SMSREC1\n'
+    RECORD = struct.Struct ('<dBI')
+    WRITE = 0
+    READ = 1
+
+    def __init__ (self, port, path):
+        self.port = port
+        self.file = open (path, 'wb')
+        self.file.write (self.MAGIC)
+        self.start = time()
+
+    def record (self, direction, data):
+        self.file.write (self.RECORD.pack (time() - self.start,    \
+            direction, len (data)) + data)
+        self.file.flush()
+
+    def write (self, data):
+        self.record (self.WRITE, bytes (data))
+        return self.port.write (data)
+
+    def read (self, size = 1):
+        data = self.port.read (size)
+        self.record (self.READ, data)
+        return data
+
+    def flush (self):
+        self.port.flush()
+
+    def close (self):
+        self.file.close()
+        self.port.close()
+
+    def __getattr__ (self, name):
+        """everything else goes straight to the serial port"""
+        return getattr (self.port, name)
+
+class ReplayPort (object):
+    """Stands in for serial port, feeds back file made by RecordingPort.
+    speed - 1 keeps original timing of modem responses,
+    higher values compress it, 0 replays without waiting.
+    Reads past the recorded ones time out like serial port
+    (timeout seconds of replay time, see clock).
+    Last record cut off by killed recording is dropped.
+    Raises ValueError if written bytes differ from the recording."""
+
+    def __init__ (self, path, speed = 1.0, timeout = 0.2):
+        self.speed = speed
+        self.timeout = timeout
+        self.records = list()
+        with open (path, 'rb') as f:
+            data = f.read()
+        if data[:len (RecordingPort.MAGIC)] != RecordingPort.MAGIC:
+            raise ValueError ('not a serial recording: ' + str (path))
+        offset = len (RecordingPort.MAGIC)
+        size = RecordingPort.RECORD.size
+        while offset + size <= len (data):
+            stamp, direction, length =    \
+                RecordingPort.RECORD.unpack_from (data, offset)
+            offset += size
+            if offset + length > len (data): break  # cut off
+            self.records.append ((stamp, direction, data[offset:offset + length]))
+            offset += length
+        self.records.reverse()  # pop from the end
+        self.last = 0.0
+
+    def write (self, data):
+        if not self.records or self.records[-1][1] != RecordingPort.WRITE:
+            raise ValueError ('replay diverged, unexpected write: '  \
+                + str (bytes (data)))
+        stamp, _, recorded = self.records.pop()
+        if recorded != bytes (data):
+            raise ValueError ('replay diverged, wrote ' + str (bytes (data))   \
+                + ' instead of ' + str (recorded))
+        self.last = stamp
+        return len (data)
+
+    def read (self, size = 1):
+        """Waits as long as modem took to respond, only host side
+        delays (between read and next write) are not replayed."""
+        if not self.records or self.records[-1][1] != RecordingPort.READ:
+            if self.speed > 0: sleep (self.timeout / self.speed)
+            self.last += self.timeout
+            return b''
+        stamp, direction, data = self.records.pop()
+        if self.speed > 0 and stamp > self.last:
+            sleep ((stamp - self.last) / self.speed)
+        self.last = stamp
+        if len (data) > size:   # hand out the rest on next read
+            self.records.append ((stamp, direction, data[size:]))
+            data = data[:size]
+        return data
+
+    def clock (self):
+        """Returns float - replay time in seconds of the recording,
+        for deadlines which have to hold at any speed."""
+        return self.last
+
+    def flush (self):
+        pass
+
+    def close (self):
+        pass
+
 class Modem (object):
     """Represents USB mobile broadband modem"""
 
@@ -34,15 +146,27 @@ class Modem (object):
         happen only once. This should awoid multiple access on port."""
         pass
 
-    def getPort (self):
+    def getPort (self, record = None, port = '/dev/ttyUSB0', exclusive = False):
         """opens USB port:
-        use write_timeout or writeTimeout depending on version of pyserial"""
-        self.port = serial.Serial (port = '/dev/ttyUSB0',   \
+        use write_timeout or writeTimeout depending on version of pyserial.
+        record - path of file to record the serial session to.
+        exclusive - fail if port is locked (flock) by other program -
+        network manager and pppd don't lock it. Needs pyserial 3.3+."""
+        options = dict (exclusive = True) if exclusive else dict()
+        self.port = serial.Serial (port = port,             \
                                baudrate = 9600,           \
                                 timeout = 0.2,              \
-                           writeTimeout = 0.2)#,              \
+                           writeTimeout = 0.2,              \
+                                **options)
                                  #rtscts = True)
                                 #xonxoff = True)
+        if record is not None:
+            self.port = RecordingPort (self.port, record)
+
+    def replayPort (self, path, speed = 1.0):
+        """Uses session recorded by getPort instead of USB port,
+        so that chat, readSMS, sendSMS... run without modem."""
+        self.port = ReplayPort (path, speed)
  
     def chat (self, command):
         """sends bytearray containing command to modem,
@@ -119,6 +243,56 @@ class Modem (object):
         if cnt > 0: return False
         return True
 
+    def value (self, command, prefix = b''):
+        """Returns bytes - first line of response starting with prefix,
+        without the prefix. If requst doesn't succeed, returns None."""
+        response = self.chat (command)
+        try:
+            if response[-1] != b'OK': return None
+        except IndexError:
+            return None
+        for line in response[:-1]:
+            if line.startswith (prefix): return line[len (prefix):].strip()
+        return None
+
+    def imei (self):
+        """Returns str - IMEI of modem, empty if request doesn't succeed."""
+        value = self.value (b'AT+CGSN\r')
+        return '' if value is None else value.decode ('ASCII', 'replace')
+
+    def imsi (self):
+        """Returns str - IMSI of SIM card, empty if request doesn't succeed."""
+        value = self.value (b'AT+CIMI\r')
+        return '' if value is None else value.decode ('ASCII', 'replace')
+
+    def operator (self):
+        """Returns str - name of current operator,
+        empty if not registered or request doesn't succeed."""
+        value = self.value (b'AT+COPS?\r', b'+COPS:')
+        try:
+            return value.split (b'"')[1].decode ('ASCII', 'replace')
+        except (AttributeError, IndexError):
+            return ''
+
+    def signal (self):
+        """Returns int - signal strength 0-31, 99 if not known.
+        If requst doesn't succeed, returns -1."""
+        value = self.value (b'AT+CSQ\r', b'+CSQ:')
+        try:
+            return int (value.split (b',')[0])
+        except (AttributeError, ValueError):
+            return -1
+
+    def registration (self):
+        """Returns int - registration status from AT+CREG?:
+        0 not searching, 1 home network, 2 searching, 3 denied,
+        4 unknown, 5 roaming. If requst doesn't succeed, returns -1."""
+        value = self.value (b'AT+CREG?\r', b'+CREG:')
+        try:
+            return int (value.split (b',')[1])
+        except (AttributeError, IndexError, ValueError):
+            return -1
+
     def isPINok (self):
         """Checks that sim is unlocked (isn't waiting for pin)"""
         return self.chat (b'AT+CPIN?\r') == [b'+CPIN: READY', b'OK']
@@ -145,14 +319,14 @@ class Modem (object):
         """Sets SMS encoding scheme to IRA - just works.
         The setting has tendency to change by itself wich causes
         ERROR 302 on working with sms."""
-        return modem.chat (b'AT+CSCS="IRA"\r') == [b'OK']
+        return self.chat (b'AT+CSCS="IRA"\r') == [b'OK']
 
     def setStorageSM (self):
         """Sets SMS storage to SIM card - just works.
         The setting has tendency to change by itself wich causes
         ERROR 302 on working with sms."""
         try:
-            return modem.chat (b'AT+CPMS="SM"\r')[1] == b'OK'
+            return self.chat (b'AT+CPMS="SM"\r')[1] == b'OK'
         except IndexError:
             pass
         return False
@@ -161,15 +335,62 @@ class Modem (object):
         """Deletes all SMS messages stored on modem."""
         return  self.chat (b'AT+CMGD=0,4\r') == [b'OK']
 
+    def storages (self):
+        """Returns list of str - SMS memories (ME, SM, MT...) supported
+        by modem alike for reading, writing and receiving."""
+        response = self.chat (b'AT+CPMS=?\r')
+        try:
+            if response[-1] != b'OK': return []
+            if response[0][:7] != b'+CPMS: ': return []
+        except IndexError:
+            return []
+        memories = None
+        for group in response[0][7:].split (b'),('):
+            names = group.strip (b'()').replace (b'"', b'').split (b',')
+            names = set (name.decode ('ASCII', 'replace') for name in names)
+            memories = names if memories is None else memories & names
+        return sorted (name for name in memories if name)
+
+    def storageStatus (self):
+        """Returns list of tuples (str (memory), int (used), int (total))
+        for read, write and receive memory - full AT+CPMS? response.
+        If requst doesn't succeed, returns empty list."""
+        return self.parseStorage (self.chat (b'AT+CPMS?\r'), [])
+
+    def setStorage (self, memory, receive = None):
+        """Sets SMS memories for reading and writing to memory,
+        for receiving to receive (memory if not given).
+        Returns list like storageStatus, empty if it doesn't succeed."""
+        names = [str (memory)] * 2 + [str (receive or memory)]
+        response = self.chat (b'AT+CPMS=' + b','.join (    \
+            b'"' + bytearray (name, 'ASCII') + b'"' for name in names) + b'\r')
+        return self.parseStorage (response, names)
+
+    def parseStorage (self, response, names):
+        """Parses +CPMS response of query or set command (which doesn't
+        name memories - names holds them then)."""
+        try:
+            if response[-1] != b'OK': return []
+            if response[0][:7] != b'+CPMS: ': return []
+            names = list (names)
+            numbers = list()
+            for field in response[0][7:].split (b','):
+                field = field.strip()
+                if field[:1] == b'"':
+                    names.append (field.strip (b'"').decode ('ASCII', 'replace'))
+                else:
+                    numbers.append (int (field))
+        except (IndexError, ValueError):
+            return []
+        return [(name, used, total) for name, used, total   \
+            in zip (names, numbers[0::2], numbers[1::2])]
+
     def cntSMS (self):
         """Returns int - number of sms messages currently in storage.
         If requst doesn't succeed, returns -1."""
-        response = modem.chat (b'AT+CPMS?\r')
-        try:
-            if response[1] != b'OK': return -1
-            return int (str (response[0]).split (',')[1])
-        except IndexError:
-            return -1
+        status = self.storageStatus()
+        if not status: return -1
+        return status[0][1]
         
     def sendSMS (self, to, message):
         """Sends sms in text mode. to - number to send SMS to.
@@ -177,7 +398,6 @@ class Modem (object):
         response = self.chat (  \
             b'AT+CMGS="'        \
             + bytearray (str (to), 'ASCII') + b'"\r')
-        print (response)
         if response[0] != b'> ': return False   # prompt for sms input
         response = self.chat (                  \
             bytearray (str (message), 'ASCII')  \
@@ -210,9 +430,10 @@ class Modem (object):
             n += 1
         return messages
 
-modem = Modem()
-modem.getPort()
-print (modem.readSMS())
+if __name__ == '__main__':
+    modem = Modem()
+    modem.getPort()
+    print (modem.readSMS())
 #print (modem.initCellular())
 #print (modem.initSMS())
 #print (modem.isOK())